@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+File Version Saver - benchmarks
+Times VersionSaver start-up, save_version, get_versions, restore_version, remove_version
+and index migration against synthetic stores built in a temporary home folder, and
+writes the results as JSON so that runs can be compared and regressions flagged:
+
+    python benchmark_version_saver.py --entries 10000 1000000 --sizes 1K 1M 4G -o after.json
+    python benchmark_version_saver.py --compare before.json after.json
+
+Synthetic index entries make the index as large as a long-used store's; a share of them
+(--folder-share) also get a version folder with metadata.json and a payload, for the
+start-up scan to walk, cold (scan_state.json removed) and incrementally. Files are real
+and are saved, restored and removed for real.
+"""
+
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from version_saver import INDEX_BACKENDS, STORAGE_MODES, VersionSaver
+
+SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+# Synthetic index entries per tracked file
+VERSIONS_PER_FILE = 100
+# Share of synthetic entries that also get a version folder on disk
+DEFAULT_FOLDER_SHARE = 0.1
+# Ratio of a benchmark's median to the baseline's above which it counts as a regression
+DEFAULT_THRESHOLD = 1.25
+WRITE_BLOCK_SIZE = 1024 * 1024
+
+
+def parse_size(text):
+    """Bytes in a size such as 512, 1K, 10M or 4G"""
+    text = text.strip().upper().rstrip("B") or "0"
+    unit = text[-1] if text[-1] in SIZE_UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def size_label(size):
+    for unit in ("G", "M", "K"):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return str(size)
+
+
+@contextmanager
+def temp_home(settings):
+    """A scratch home folder holding a .versiontracker with the given settings, in place of
+    the user's for the duration (Path.home() reads HOME / USERPROFILE on every call)"""
+    saved = {name: os.environ.get(name) for name in ("HOME", "USERPROFILE")}
+    with tempfile.TemporaryDirectory(prefix="version_saver_bench-") as home:
+        tracker_dir = Path(home) / ".versiontracker"
+        tracker_dir.mkdir()
+        with open(tracker_dir / "settings.json", "w", encoding="utf-8") as f:
+            json.dump(settings, f)
+        os.environ["HOME"] = os.environ["USERPROFILE"] = home
+        try:
+            yield Path(home)
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+
+def write_file(path, size):
+    """Write size bytes of incompressible data (one random block, repeated)"""
+    block = os.urandom(min(size, WRITE_BLOCK_SIZE))
+    with open(path, "wb") as f:
+        for _ in range(size // len(block) if block else 0):
+            f.write(block)
+        f.write(block[:size % len(block)] if block else b"")
+
+
+def touch_file(path, index):
+    """Change a few bytes at the start of path, so that each save stores a new version"""
+    with open(path, "r+b") as f:
+        f.write(f"{index:08d}".encode()[:max(1, min(8, os.path.getsize(path)))])
+
+
+def synthetic_entries(count, tracker_dir, file_ids=(), versions_per_file=VERSIONS_PER_FILE, first=0):
+    """count index entries in the layout save_version produces, versions_per_file to a file,
+    numbered from first. The first files take their ids from file_ids, the rest are made up."""
+    file_ids = list(file_ids)
+    started = datetime(2020, 1, 1)
+    for n in range(first, first + count):
+        file_no, version_no = divmod(n, versions_per_file)
+        file_id = file_ids[file_no] if file_no < len(file_ids) else f"bench-{file_no:08d}"
+        saved_at = started + timedelta(minutes=n)
+        timestamp = saved_at.strftime("%Y-%m-%dT%H-%M-%S")
+        file_name = f"file{file_no}.txt"
+        version_dir = tracker_dir / file_id / f"{timestamp}-{version_no}"
+        yield {
+            "file_id": file_id,
+            "file_name": file_name,
+            "version_file_path": str(version_dir / file_name),
+            "timestamp": timestamp,
+            "comment": "",
+            "storage_location": str(tracker_dir),
+            "metadata_path": str(version_dir / "metadata.json"),
+            "saved_at": saved_at.isoformat(),
+            "file_size": 1024,
+            "file_modified": saved_at.isoformat(),
+            "storage": "copy",
+            "stored_size": 1024,
+        }
+
+
+def write_version_folders(entries, share=1.0):
+    """Create the version folder of a share (0 to 1) of entries, spread evenly over them:
+    a payload of the entry's size and metadata.json as save_version writes it. Returns
+    the number of folders written."""
+    written = 0
+    for n, entry in enumerate(entries):
+        if int((n + 1) * share) == int(n * share):
+            continue
+        version_file = Path(entry["version_file_path"])
+        version_file.parent.mkdir(parents=True)
+        with open(version_file, "wb") as f:
+            f.write(bytes(entry["file_size"]))
+        metadata = {field: entry[field] for field in ("saved_at", "file_size", "file_modified", "comment",
+                                                      "file_id", "file_name", "storage", "stored_size")}
+        with open(entry["metadata_path"], "w", encoding="utf-8") as f:
+            json.dump(metadata, f, indent=2)
+        written += 1
+    return written
+
+
+def populate(version_saver, count, file_ids=()):
+    """Add count synthetic entries to the index in one commit"""
+    with version_saver.batch():
+        version_saver.index.add_many(synthetic_entries(count, version_saver.version_tracker_dir, file_ids))
+
+
+def timed(fn, repeat=1, setup=None):
+    """Wall-clock seconds of repeat calls of fn; setup runs untimed before each"""
+    times = []
+    for i in range(repeat):
+        argument = setup(i) if setup else None
+        started = time.perf_counter()
+        fn(argument) if setup else fn()
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def result(benchmark, times, **params):
+    return dict(benchmark=benchmark, **params, times=times, median=statistics.median(times))
+
+
+def bench_index(entries, backend, repeat, folder_share=DEFAULT_FOLDER_SHARE):
+    """Start-up and get_versions against an index of entries entries, folder_share of them
+    with a version folder on disk"""
+    results = []
+    with temp_home({"index_backend": backend}) as home:
+        tracker_dir = home / ".versiontracker"
+        tracked = home / "tracked.txt"
+        write_file(tracked, 1024)
+        version_saver = VersionSaver()
+        file_ids = [version_saver.get_file_id(tracked)]
+        times = timed(lambda: populate(version_saver, entries, file_ids))
+        results.append(result("populate", times, backend=backend, entries=entries))
+        version_saver.close()
+        write_version_folders(synthetic_entries(entries, tracker_dir, file_ids), folder_share)
+        params = dict(backend=backend, entries=entries, folder_share=folder_share)
+
+        def construct(_=None):
+            VersionSaver().close()
+        construct()  # records the scan state
+
+        def forget_scan(_):
+            (tracker_dir / "scan_state.json").unlink()
+        results.append(result("construct_cold", timed(construct, repeat, setup=forget_scan), **params))
+        results.append(result("construct", timed(construct, repeat), **params))
+
+        def save_elsewhere(i):
+            # A version saved by another process since the last start
+            entry = next(synthetic_entries(1, tracker_dir, first=entries + i))
+            write_version_folders([entry])
+            return entry["version_file_path"]
+
+        def rescan(version_file_path):
+            version_saver = VersionSaver()
+            assert version_saver.index.get(version_file_path) is not None, "The rescan missed a new version"
+            version_saver.close()
+        results.append(result("rescan", timed(rescan, repeat, setup=save_elsewhere), **params))
+        version_saver = VersionSaver()
+        times = timed(lambda: version_saver.get_versions(tracked), repeat)
+        results.append(result("get_versions", times, backend=backend, entries=entries))
+        version_saver.close()
+    return results
+
+
+def bench_migration(entries, backend, folder_share=DEFAULT_FOLDER_SHARE):
+    """First start-up with backend over a legacy index.json of entries entries, folder_share
+    of them with a version folder on disk"""
+    with temp_home({"index_backend": "json"}) as home:
+        tracker_dir = home / ".versiontracker"
+        with open(tracker_dir / "index.json", "w", encoding="utf-8") as f:
+            json.dump(list(synthetic_entries(entries, tracker_dir)), f)
+        write_version_folders(synthetic_entries(entries, tracker_dir), folder_share)
+        with open(tracker_dir / "settings.json", "w", encoding="utf-8") as f:
+            json.dump({"index_backend": backend}, f)
+
+        def migrate():
+            version_saver = VersionSaver()
+            assert len(version_saver.index) >= entries, "Migration lost entries"
+            version_saver.close()
+        return [result("migrate", timed(migrate), backend=backend, entries=entries, folder_share=folder_share)]
+
+
+def bench_file(size, backend, storage_mode, entries, repeat):
+    """save_version, restore_version and remove_version of a size-byte file"""
+    params = dict(backend=backend, storage_mode=storage_mode, size=size, entries=entries)
+    with temp_home({"index_backend": backend, "storage_mode": storage_mode}) as home:
+        version_saver = VersionSaver()
+        populate(version_saver, entries)
+        target = home / f"file-{size_label(size)}.bin"
+        write_file(target, size)
+
+        def save(_):
+            success, message = version_saver.save_version(target, "Benchmark", force=True)
+            assert success, message
+        times = timed(save, repeat, setup=lambda i: touch_file(target, i))
+        results = [result("save_version", times, **params)]
+        versions = [v["path"] for v in version_saver.get_versions(target)]
+
+        def restore(i):
+            success, message = version_saver.restore_version(versions[i % len(versions)], target)
+            assert success, message
+        results.append(result("restore_version", timed(restore, repeat, setup=lambda i: i), **params))
+
+        def remove(i):
+            success, message = version_saver.remove_version(versions[i])
+            assert success, message
+        results.append(result("remove_version", timed(remove, len(versions), setup=lambda i: i), **params))
+        version_saver.close()
+    return results
+
+
+def run_benchmarks(entries=(10000,), sizes=(1024,), backends=("sqlite",), storage_modes=("copy",),
+                   repeat=3, migrate=True, progress=print, folder_share=DEFAULT_FOLDER_SHARE):
+    """Run every benchmark for every combination; returns the results document"""
+    results = []
+
+    def report(new):
+        for r in new:
+            label = " ".join(f"{key}={size_label(value) if key == 'size' else value}"
+                             for key, value in r.items() if key not in ("benchmark", "times", "median"))
+            progress(f"📊 {r['benchmark']:<16} {label}: {r['median'] * 1000:.1f} ms")
+        results.extend(new)
+
+    for backend in backends:
+        for count in entries:
+            report(bench_index(count, backend, repeat, folder_share))
+            if migrate and backend != "json":
+                report(bench_migration(count, backend, folder_share))
+        for storage_mode in storage_modes:
+            for size in sizes:
+                report(bench_file(size, backend, storage_mode, min(entries), repeat))
+    return {
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+
+
+def result_key(r):
+    return tuple(sorted((key, value) for key, value in r.items() if key not in ("times", "median")))
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """(key, baseline median, current median) for every benchmark in both documents whose
+    median grew by more than threshold times"""
+    before = {result_key(r): r["median"] for r in baseline["results"]}
+    regressions = []
+    for r in current["results"]:
+        old = before.get(result_key(r))
+        if old and r["median"] > old * threshold:
+            regressions.append((result_key(r), old, r["median"]))
+    return regressions
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="File Version Saver benchmarks")
+    parser.add_argument("--entries", type=int, nargs="+", default=[10000],
+                        help="Index sizes to benchmark (synthetic entries)")
+    parser.add_argument("--sizes", nargs="+", default=["1K", "1M", "100M"],
+                        help="File sizes to save, restore and remove (e.g. 1K 10M 4G)")
+    parser.add_argument("--backends", nargs="+", default=["sqlite"], choices=INDEX_BACKENDS)
+    parser.add_argument("--storage-modes", nargs="+", default=["copy"], choices=STORAGE_MODES)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark")
+    parser.add_argument("--folder-share", type=float, default=DEFAULT_FOLDER_SHARE,
+                        help="Share (0 to 1) of synthetic entries given a version folder on disk "
+                             "for the start-up scan")
+    parser.add_argument("--no-migrate", action="store_true", help="Skip the index.json migration benchmark")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", nargs="+", metavar="RESULTS",
+                        help="Baseline results to compare against: with one file, this run is compared "
+                             "to it; with two, the second file is compared to the first without running")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Flag benchmarks whose median grew by more than this factor")
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 1:
+        with open(args.compare[1], "r", encoding="utf-8") as f:
+            current = json.load(f)
+    else:
+        current = run_benchmarks(args.entries, [parse_size(s) for s in args.sizes], args.backends,
+                                 args.storage_modes, args.repeat, not args.no_migrate,
+                                 folder_share=args.folder_share)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(current, f, indent=2)
+            print(f"✅ Results written to {args.output}")
+    if args.compare:
+        with open(args.compare[0], "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        for key, old, new in regressions:
+            label = " ".join(f"{name}={value}" for name, value in key)
+            print(f"❌ Regression: {label}: {old * 1000:.1f} ms -> {new * 1000:.1f} ms")
+        if regressions:
+            sys.exit(1)
+        print(f"✅ No benchmark slower than {args.threshold:g}x the baseline")
+
+
+if __name__ == "__main__":
+    main()
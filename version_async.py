@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+File Version Saver - asyncio API
+AsyncVersionSaver wraps a VersionSaver for use from an event loop: file I/O runs on a
+bounded thread pool, index changes are committed in groups by a single committer, and a
+cancelled save takes its version back out.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from version_saver import VersionSaver
+
+
+class AsyncVersionSaver:
+    """Awaitable save_version, get_versions, restore_version and remove_version.
+
+    At most max_io operations touch the disk at once (default: the "save_jobs" setting,
+    or twice the CPU count up to 8); the rest wait without holding a thread. Operations
+    run with their index commits held back: each one waits for the next group commit,
+    which a single committer runs on its own thread, and every operation that finished
+    while the previous commit was being written shares it. commit_delay (seconds) holds
+    each commit back a little to let more operations join.
+
+    A copy cannot be interrupted once it has started. When a save is cancelled, the
+    version it was making is removed as soon as the copy ends (save_version itself
+    deletes a partial version folder when a save fails), and its I/O slot is held until
+    then. Cancelling a restore or remove leaves it to complete.
+
+    Use it as an async context manager, or await aclose() when done."""
+
+    def __init__(self, version_saver=None, max_io=None, commit_delay=0.0):
+        # Creating a VersionSaver loads the index; use AsyncVersionSaver.open() to do that
+        # off the event loop
+        self.version_saver = version_saver or VersionSaver()
+        self._owns_saver = version_saver is None
+        max_io = max_io or self.version_saver.settings["save_jobs"] or min(8, (os.cpu_count() or 1) * 2)
+        self.commit_delay = commit_delay
+        self._io = asyncio.Semaphore(max_io)
+        self._executor = ThreadPoolExecutor(max_workers=max_io, thread_name_prefix="version-io")
+        self._commit_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="version-commit")
+        self._next_commit = None  # future of the commit that operations finishing now join
+        self._committer = None
+        self._cleanups = set()
+        self.commits = 0
+
+    @classmethod
+    async def open(cls, settings=None, max_io=None, commit_delay=0.0):
+        """Create an AsyncVersionSaver, loading the index on a worker thread"""
+        loop = asyncio.get_running_loop()
+        version_saver = await loop.run_in_executor(None, VersionSaver, settings)
+        saver = cls(version_saver, max_io, commit_delay)
+        saver._owns_saver = True
+        return saver
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def save_version(self, file_path, comment=None, base_dir=None, force=False):
+        """Save a version of file_path; returns (success, message) like VersionSaver"""
+        status, message, _ = await self._run(self.version_saver._save_version, file_path, comment,
+                                             base_dir, force, undo=self._undo_save)
+        return status != "failed", message
+
+    async def get_versions(self, file_path):
+        return await self._run(self.version_saver.get_versions, file_path, commit=False)
+
+    async def restore_version(self, version_path, original_path):
+        return await self._run(self.version_saver.restore_version, version_path, original_path)
+
+    async def remove_version(self, version_path):
+        return await self._run(self.version_saver.remove_version, version_path)
+
+    async def _run(self, function, *args, commit=True, undo=None):
+        """Call function(*args) on the I/O pool once a slot is free and, if commit is set,
+        wait for the group commit that includes its changes. If the caller is cancelled,
+        undo(result) is run in the background once the call has finished."""
+        loop = asyncio.get_running_loop()
+        await self._io.acquire()
+        job = loop.run_in_executor(self._executor, self._held, function, *args)
+        try:
+            result = await asyncio.shield(job)
+        except asyncio.CancelledError:
+            self._cleanup(self._after_cancel(job, undo, release=True))
+            raise
+        except BaseException:
+            self._io.release()
+            raise
+        self._io.release()
+        if commit:
+            try:
+                await self._commit()
+            except asyncio.CancelledError:
+                self._cleanup(self._after_cancel(job, undo, release=False))
+                raise
+        return result
+
+    def _cleanup(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._cleanups.add(task)
+        task.add_done_callback(self._cleanups.discard)
+
+    async def _after_cancel(self, job, undo, release):
+        try:
+            try:
+                result = await job
+            finally:
+                if release:
+                    self._io.release()
+            if undo is not None:
+                await asyncio.get_running_loop().run_in_executor(self._executor, self._held, undo, result)
+            await self._commit()
+        except Exception as e:
+            print(f"Error cleaning up a cancelled operation: {e}")
+
+    def _held(self, function, *args):
+        """Run function(*args) on this thread, leaving its index commit to the committer"""
+        with self.version_saver._hold_commits():
+            return function(*args)
+
+    def _undo_save(self, result):
+        status, _, entry = result
+        if status == "saved":
+            self.version_saver.remove_version(entry["version_file_path"])
+
+    async def _commit(self):
+        """Wait for a commit of everything done so far. Callers arriving while a commit is
+        being written share the one after it."""
+        if self._next_commit is None:
+            self._next_commit = asyncio.get_running_loop().create_future()
+        waiter = self._next_commit
+        if self._committer is None or self._committer.done():
+            self._committer = asyncio.ensure_future(self._run_commits())
+        await asyncio.shield(waiter)
+
+    async def _run_commits(self):
+        loop = asyncio.get_running_loop()
+        while self._next_commit is not None:
+            await asyncio.sleep(self.commit_delay)
+            waiter, self._next_commit = self._next_commit, None
+            try:
+                await loop.run_in_executor(self._commit_executor, self.version_saver.commit)
+                self.commits += 1
+            except Exception as e:
+                waiter.set_exception(e)
+            else:
+                waiter.set_result(None)
+
+    async def aclose(self):
+        """Finish cleanups and commits, commit anything left and shut the thread pools down"""
+        while self._cleanups:
+            await asyncio.gather(*list(self._cleanups), return_exceptions=True)
+        if self._committer is not None:
+            await self._committer
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._commit_executor, self.version_saver._save_index)
+        self._executor.shutdown()
+        self._commit_executor.shutdown()
+        if self._owns_saver:
+            self.version_saver.close()
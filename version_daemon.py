@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+File Version Saver - background service
+Keeps one VersionSaver (with its index loaded) resident and serves requests from the
+short-lived context-menu processes over a local socket (a named pipe on Windows)
+"""
+
+import os
+import hashlib
+import threading
+from pathlib import Path
+
+# VersionSaver methods a client may call through the service
+DAEMON_METHODS = {
+    "save_version", "save_many", "unchanged_version", "get_versions", "restore_version",
+    "open_version", "remove_version", "dedup_stats", "reindex", "prune", "diff_versions",
+}
+
+
+def default_tracker_dir():
+    return Path.home() / ".versiontracker"
+
+
+def daemon_address(tracker_dir):
+    """Socket path (POSIX) or pipe name (Windows) of the service for a tracker folder"""
+    if os.name == "nt":
+        tag = hashlib.sha256(str(tracker_dir).encode("utf-8")).hexdigest()[:16]
+        return rf"\\.\pipe\versiontracker-{tag}"
+    return str(Path(tracker_dir) / "daemon.sock")
+
+
+def _key_file(tracker_dir):
+    return Path(tracker_dir) / "daemon.key"
+
+
+def _read_key(tracker_dir):
+    with open(_key_file(tracker_dir), "r", encoding="utf-8") as f:
+        return bytes.fromhex(f.read().strip())
+
+
+def _write_key(tracker_dir):
+    """Create a fresh secret readable only by the current user"""
+    key = os.urandom(32)
+    key_file = _key_file(tracker_dir)
+    tmp_file = key_file.with_name(key_file.name + ".tmp")
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(key.hex())
+    os.replace(tmp_file, key_file)
+    return key
+
+
+class DaemonClient:
+    """Stand-in for VersionSaver that forwards method calls to the running service.
+    If the service goes away mid-session, calls fall back to a local saver from fallback()."""
+
+    def __init__(self, conn, fallback=None):
+        self._conn = conn
+        self._fallback = fallback
+        self._local = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, tracker_dir=None, fallback=None):
+        """Connect to the service, returning None if it is not running"""
+        tracker_dir = tracker_dir or default_tracker_dir()
+        address = daemon_address(tracker_dir)
+        if os.name != "nt" and not os.path.exists(address):
+            return None
+        # Imported only once a service looks reachable, to keep the no-service path cheap
+        from multiprocessing.connection import Client, AuthenticationError
+        try:
+            conn = Client(address, authkey=_read_key(tracker_dir))
+        except (OSError, EOFError, AuthenticationError):
+            return None
+        return cls(conn, fallback)
+
+    def _call(self, name, args, kwargs):
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.send((name, args, kwargs))
+                    ok, result = self._conn.recv()
+                except (OSError, EOFError):
+                    self._conn = None
+                else:
+                    if not ok:
+                        raise RuntimeError(result)
+                    return result
+            if self._fallback is None:
+                raise ConnectionError("Version saver service is not available")
+            if self._local is None:
+                self._local = self._fallback()
+        return getattr(self._local, name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name not in DAEMON_METHODS:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call(name, args, kwargs)
+
+    def shutdown(self):
+        """Ask the service to stop"""
+        with self._lock:
+            self._conn.send(("shutdown", (), {}))
+            self._conn.recv()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._local is not None:
+            self._local.close()
+
+
+class VersionDaemon:
+    """Serve a VersionSaver to local clients, one thread per connection"""
+
+    def __init__(self, version_saver, address=None):
+        self.version_saver = version_saver
+        tracker_dir = version_saver.version_tracker_dir
+        self.address = address or daemon_address(tracker_dir)
+        running = DaemonClient.connect(tracker_dir)
+        if running is not None:
+            running.close()
+            raise RuntimeError(f"Version saver service already running on {self.address}")
+        if os.name != "nt" and os.path.exists(self.address):
+            os.unlink(self.address)  # left behind by a service that did not shut down cleanly
+        from multiprocessing.connection import Listener
+        self._key = _write_key(tracker_dir)
+        self._listener = Listener(self.address, authkey=self._key)
+        self._stopping = threading.Event()
+
+    def _prune_periodically(self, interval):
+        """Apply the retention policy every interval seconds until shutdown"""
+        while not self._stopping.wait(interval):
+            try:
+                self.version_saver.index.refresh()
+                self.version_saver.prune()
+            except Exception as e:
+                print(f"Background prune failed: {e}")
+
+    def serve_forever(self):
+        from multiprocessing.connection import AuthenticationError
+        hours = self.version_saver.settings.get("prune_interval_hours")
+        if hours:
+            threading.Thread(target=self._prune_periodically, args=(hours * 3600,), daemon=True).start()
+        try:
+            while not self._stopping.is_set():
+                try:
+                    conn = self._listener.accept()
+                except (AuthenticationError, EOFError, ConnectionError):
+                    continue
+                except OSError:
+                    break
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self._listener.close()
+
+    def shutdown(self):
+        """Stop accepting connections and return from serve_forever"""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        # Wake the accept() call; closing the listener alone does not on every platform
+        from multiprocessing.connection import Client, AuthenticationError
+        try:
+            Client(self.address, authkey=self._key).close()
+        except (OSError, EOFError, AuthenticationError):
+            pass
+
+    def _handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    name, args, kwargs = conn.recv()
+                except (OSError, EOFError):
+                    return
+                if name == "shutdown":
+                    conn.send((True, None))
+                    self.shutdown()
+                    return
+                try:
+                    if name not in DAEMON_METHODS:
+                        raise AttributeError(f"Unknown method: {name}")
+                    # Pick up versions saved by processes that bypassed the service
+                    self.version_saver.index.refresh()
+                    result = (True, getattr(self.version_saver, name)(*args, **kwargs))
+                except Exception as e:
+                    result = (False, f"{type(e).__name__}: {e}")
+                try:
+                    conn.send(result)
+                except (OSError, EOFError):
+                    return
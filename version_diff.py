@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+File Version Saver - diff
+Streaming comparison of two versions (or a version and the live file): a unified line
+diff for text and a summary of changed byte ranges for everything else. Inputs are read
+in bounded windows, so memory does not grow with file size.
+"""
+
+from collections import deque
+from difflib import SequenceMatcher
+
+from version_storage import read_full
+
+# Bytes sniffed from the start of each side to decide between a text and a binary diff
+SNIFF_SIZE = 8192
+# Lines of each side held in memory while aligning them
+DIFF_WINDOW_LINES = 4096
+# Granularity of the changed ranges reported for binary files
+DIFF_BLOCK_SIZE = 4096
+READ_SIZE = 1024 * 1024
+# Bytes read at a time when splitting text into lines
+LINE_READ_SIZE = 64 * 1024
+
+
+def is_text(head):
+    """Whether a file starting with head looks like UTF-8 text"""
+    if b"\0" in head:
+        return False
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off by the end of the sample is still text
+        return e.start >= len(head) - 3 and e.reason == "unexpected end of data"
+    return True
+
+
+def iter_lines(stream):
+    """Decoded lines, without the trailing newline, read from a binary stream in blocks"""
+    rest = b""
+    for block in iter(lambda: stream.read(LINE_READ_SIZE), b""):
+        lines = (rest + block).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode("utf-8", errors="replace")
+    if rest:
+        yield rest.decode("utf-8", errors="replace")
+
+
+def line_opcodes(a_lines, b_lines, window=DIFF_WINDOW_LINES):
+    """Align two line iterators, yielding (tag, a_start, b_start, a_chunk, b_chunk) with tag
+    "equal", "replace", "delete" or "insert", as difflib does for whole sequences.
+
+    Up to window lines of each side are aligned at a time. Everything up to the last match
+    in the window is emitted and the remainder carried into the next window, so a change
+    is only missed as a move when its lines are more than a window apart."""
+    a_lines, b_lines = iter(a_lines), iter(b_lines)
+    a_buf, b_buf = [], []
+    a_pos = b_pos = 0
+    while True:
+        a_buf.extend(line for _, line in zip(range(window - len(a_buf)), a_lines))
+        b_buf.extend(line for _, line in zip(range(window - len(b_buf)), b_lines))
+        if not a_buf and not b_buf:
+            return
+        at_end = len(a_buf) < window and len(b_buf) < window
+        matcher = SequenceMatcher(None, a_buf, b_buf, autojunk=False)
+        if at_end:
+            cut_a, cut_b = len(a_buf), len(b_buf)
+        else:
+            blocks = [block for block in matcher.get_matching_blocks() if block.size]
+            if blocks:
+                cut_a, cut_b = blocks[-1].a + blocks[-1].size, blocks[-1].b + blocks[-1].size
+            else:
+                cut_a, cut_b = len(a_buf), len(b_buf)  # nothing in common within a window
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if i1 >= cut_a and j1 >= cut_b:
+                break
+            i2, j2 = min(i2, cut_a), min(j2, cut_b)
+            yield tag, a_pos + i1, b_pos + j1, a_buf[i1:i2], b_buf[j1:j2]
+        del a_buf[:cut_a], b_buf[:cut_b]
+        a_pos += cut_a
+        b_pos += cut_b
+
+
+def _format_range(start, length):
+    # As in difflib.unified_diff: 1-based, with the length left out when it is 1
+    beginning = start + 1
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def unified_diff(opcodes, label_a, label_b, context=3):
+    """Unified diff lines for the opcodes of line_opcodes, including the ---/+++ header.
+    Yields nothing when the sides are identical."""
+    recent = deque(maxlen=context)  # (a_no, b_no, line) of the latest unchanged lines
+    hunk = None
+    trailing = 0  # unchanged lines at the end of the open hunk
+
+    def close(hunk, trailing):
+        lines, a_start, b_start, a_len, b_len = hunk
+        excess = max(0, trailing - context)
+        if excess:
+            del lines[-excess:]
+            a_len -= excess
+            b_len -= excess
+        yield f"@@ -{_format_range(a_start, a_len)} +{_format_range(b_start, b_len)} @@"
+        yield from lines
+
+    header = False
+    for tag, a_no, b_no, a_chunk, b_chunk in opcodes:
+        if tag == "equal":
+            offset = 0
+            if hunk is not None:
+                # Unchanged lines join the open hunk until the gap to the next change is
+                # too wide for the two to share one
+                take = min(len(a_chunk), 2 * context - trailing)
+                hunk[0].extend(" " + line for line in a_chunk[:take])
+                hunk[3] += take
+                hunk[4] += take
+                trailing += take
+                offset = take
+                if offset == len(a_chunk):
+                    continue
+                # Its last context lines may lead into the next hunk
+                tail = [line[1:] for line in hunk[0][len(hunk[0]) - context:]] if context else []
+                recent.extend((a_no + offset - len(tail) + i, b_no + offset - len(tail) + i, line)
+                              for i, line in enumerate(tail))
+                yield from close(hunk, trailing)
+                hunk = None
+            start = max(offset, len(a_chunk) - context)
+            recent.extend((a_no + i, b_no + i, a_chunk[i]) for i in range(start, len(a_chunk)))
+            continue
+        if not header:
+            yield f"--- {label_a}"
+            yield f"+++ {label_b}"
+            header = True
+        if hunk is None:
+            lead = list(recent)
+            a_start = lead[0][0] if lead else a_no
+            b_start = lead[0][1] if lead else b_no
+            hunk = [[" " + line for _, _, line in lead], a_start, b_start, len(lead), len(lead)]
+            recent.clear()
+        hunk[0].extend("-" + line for line in a_chunk)
+        hunk[0].extend("+" + line for line in b_chunk)
+        hunk[3] += len(a_chunk)
+        hunk[4] += len(b_chunk)
+        trailing = 0
+    if hunk is not None:
+        yield from close(hunk, trailing)
+
+
+def changed_ranges(stream_a, stream_b, block_size=DIFF_BLOCK_SIZE):
+    """(start, end) byte ranges, end exclusive, in which two streams differ, found by
+    comparing them block by block. Adjacent changed blocks are merged, and bytes past the
+    end of the shorter stream count as changed."""
+    ranges = []
+    offset = 0
+
+    def mark(start, end):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    while True:
+        a = read_full(stream_a, READ_SIZE)
+        b = read_full(stream_b, READ_SIZE)
+        if not a and not b:
+            return ranges
+        if a != b:
+            for start in range(0, max(len(a), len(b)), block_size):
+                if a[start:start + block_size] != b[start:start + block_size]:
+                    mark(offset + start, offset + min(max(len(a), len(b)), start + block_size))
+        offset += max(len(a), len(b))
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+File Version Saver - storage backends
+Where version content goes when "storage_mode" is "remote". The index and each version's
+metadata.json stay in the local .versiontracker folder; only the payload is handed to
+the backend configured by the "storage_backend" setting:
+
+    {"type": "local", "path": "//server/share/versions"}
+    {"type": "s3", "endpoint": "https://s3.eu-west-1.amazonaws.com", "bucket": "versions",
+     "region": "eu-west-1", "prefix": "alice/", "access_key": "...", "secret_key": "..."}
+
+A backend stores binary content under "/"-separated keys and provides put (from a
+stream), get (as a stream), download (to a file), delete, stat and list.
+"""
+
+import hashlib
+import hmac
+import os
+import shutil
+import threading
+import urllib.parse
+from datetime import datetime, timezone
+from pathlib import Path
+
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+# S3 multipart uploads: part size (S3 itself requires at least 5 MB for all but the
+# last part) and parts transferred at once
+S3_PART_SIZE = 16 * 1024 * 1024
+S3_JOBS = 4
+S3_TIMEOUT = 60
+
+
+class StorageBackend:
+    """Interface of a payload store. Subclasses implement put, get, delete, stat and list;
+    download has a streaming default."""
+
+    def put(self, key, stream):
+        """Store everything read from the binary stream under key; returns the byte count"""
+        raise NotImplementedError
+
+    def get(self, key):
+        """The content of key as a binary stream (FileNotFoundError if there is none)"""
+        raise NotImplementedError
+
+    def download(self, key, path):
+        """Write the content of key to the file path"""
+        with self.get(key) as src, open(path, "wb") as dst:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+    def delete(self, key):
+        """Delete key; deleting a missing key is not an error"""
+        raise NotImplementedError
+
+    def stat(self, key):
+        """Size of key in bytes, or None if it does not exist"""
+        raise NotImplementedError
+
+    def list(self, prefix=""):
+        """Keys starting with prefix"""
+        raise NotImplementedError
+
+
+class LocalBackend(StorageBackend):
+    """Keys as files under a folder, typically on a network share"""
+
+    def __init__(self, path):
+        self.root = Path(path)
+
+    def _path(self, key):
+        parts = key.split("/")
+        if any(part in ("", ".", "..") for part in parts):
+            raise ValueError(f"Invalid storage key: {key!r}")
+        return self.root.joinpath(*parts)
+
+    def put(self, key, stream):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(stream, f, COPY_BUFFER_SIZE)
+                size = f.tell()
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        return size
+
+    def get(self, key):
+        return open(self._path(key), "rb")
+
+    def download(self, key, path):
+        shutil.copyfile(self._path(key), path)
+
+    def delete(self, key):
+        path = self._path(key)
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            return
+        # Drop folders the key leaves empty
+        for parent in path.parents:
+            if parent == self.root:
+                break
+            try:
+                parent.rmdir()
+            except OSError:
+                break
+
+    def stat(self, key):
+        try:
+            return self._path(key).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def list(self, prefix=""):
+        if not self.root.is_dir():
+            return
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                key = Path(dirpath, name).relative_to(self.root).as_posix()
+                if key.startswith(prefix) and not name.endswith(".tmp"):
+                    yield key
+
+
+def _quote(text, safe="-_.~"):
+    return urllib.parse.quote(text, safe=safe)
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode("utf-8"), hashlib.sha256).digest()
+
+
+def sign_v4(method, host, path, query, headers, payload_hash, access_key, secret_key, region,
+            service="s3", now=None):
+    """AWS Signature Version 4: headers (with x-amz-date, x-amz-content-sha256 and
+    Authorization added) for a request to host. path is the unencoded object path and
+    query a dict of unencoded parameters. Every header passed in is signed."""
+    now = now or datetime.now(timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date = amz_date[:8]
+    headers = dict(headers, host=host)
+    headers["x-amz-date"] = amz_date
+    headers["x-amz-content-sha256"] = payload_hash
+    canonical_headers = {name.lower(): " ".join(str(value).split()) for name, value in headers.items()}
+    signed_headers = ";".join(sorted(canonical_headers))
+    canonical_request = "\n".join([
+        method,
+        _quote(path, safe="-_.~/"),
+        "&".join(f"{_quote(k)}={_quote(v)}" for k, v in sorted(query.items())),
+        "".join(f"{name}:{canonical_headers[name]}\n" for name in sorted(canonical_headers)),
+        signed_headers,
+        payload_hash,
+    ])
+    scope = f"{date}/{region}/{service}/aws4_request"
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+    ])
+    key = ("AWS4" + secret_key).encode("utf-8")
+    for part in (date, region, service, "aws4_request"):
+        key = _hmac(key, part)
+    signature = hmac.new(key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    headers["Authorization"] = (f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+                                f"SignedHeaders={signed_headers}, Signature={signature}")
+    return headers
+
+
+class S3Error(OSError):
+    """An S3 request failed"""
+
+    def __init__(self, status, reason, body=b""):
+        super().__init__(f"S3 request failed: {status} {reason} {body[:200].decode('utf-8', 'replace')}".strip())
+        self.status = status
+
+
+def _find(element, name):
+    """Child elements named name, whether or not the S3 XML namespace is used"""
+    return [child for child in element.iter() if child.tag == name or child.tag.endswith("}" + name)]
+
+
+class S3Backend(StorageBackend):
+    """Keys as objects in an S3 bucket (or any S3-compatible service), addressed path-style
+    as <endpoint>/<bucket>/<prefix><key> and signed with Signature Version 4.
+
+    Content larger than part_size is uploaded as a multipart upload, with up to jobs parts
+    in flight at once (so at most jobs * part_size bytes are held in memory), and
+    downloaded as parallel ranged GETs. A failed upload is aborted."""
+
+    def __init__(self, endpoint, bucket, access_key=None, secret_key=None, region="us-east-1",
+                 prefix="", part_size=S3_PART_SIZE, jobs=S3_JOBS, timeout=S3_TIMEOUT):
+        url = urllib.parse.urlsplit(endpoint)
+        self.secure = url.scheme == "https"
+        self.host = url.netloc
+        self.base_path = url.path.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key or os.environ.get("AWS_ACCESS_KEY_ID", "")
+        self.secret_key = secret_key or os.environ.get("AWS_SECRET_ACCESS_KEY", "")
+        self.region = region
+        self.prefix = prefix
+        self.part_size = part_size
+        self.jobs = jobs
+        self.timeout = timeout
+
+    def _connection(self):
+        import http.client
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _request(self, method, key=None, query=None, headers=None, body=b"", ok=(200,), stream=False):
+        """Send a signed request; returns the open response if stream is set, else
+        (response, body). A status outside ok raises S3Error (FileNotFoundError for 404)."""
+        path = f"{self.base_path}/{self.bucket}"
+        if key is not None:
+            path += "/" + self.prefix + key
+        query = query or {}
+        headers = sign_v4(method, self.host, path, query, headers or {}, hashlib.sha256(body).hexdigest(),
+                          self.access_key, self.secret_key, self.region)
+        target = _quote(path, safe="-_.~/")
+        if query:
+            target += "?" + "&".join(f"{_quote(k)}={_quote(v)}" for k, v in sorted(query.items()))
+        conn = self._connection()
+        streaming = False
+        try:
+            conn.request(method, target, body=body or None, headers=headers)
+            response = conn.getresponse()
+            if response.status not in ok:
+                data = response.read()
+                if response.status == 404:
+                    raise FileNotFoundError(f"Not found in bucket {self.bucket}: {key}")
+                raise S3Error(response.status, response.reason, data)
+            if stream:
+                # Left open for the caller; closing the response releases the connection
+                streaming = True
+                return response
+            return response, response.read()
+        finally:
+            if not streaming:
+                conn.close()
+
+    def put(self, key, stream):
+        data = read_full(stream, self.part_size)
+        if len(data) < self.part_size:
+            self._request("PUT", key, body=data)
+            return len(data)
+        return self._put_multipart(key, data, stream)
+
+    def _put_multipart(self, key, first, stream):
+        from xml.etree import ElementTree
+        _, body = self._request("POST", key, query={"uploads": ""})
+        upload_id = _find(ElementTree.fromstring(body), "UploadId")[0].text
+        try:
+            etags = {}
+            total = 0
+
+            def upload(number, data):
+                response, _ = self._request("PUT", key, query={"partNumber": str(number), "uploadId": upload_id},
+                                            body=data)
+                etags[number] = response.getheader("ETag")
+
+            from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                in_flight = set()
+                number, data = 1, first
+                while data:
+                    if len(in_flight) >= self.jobs:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    in_flight.add(executor.submit(upload, number, data))
+                    total += len(data)
+                    number += 1
+                    data = read_full(stream, self.part_size)
+                for future in in_flight:
+                    future.result()
+            parts = "".join(f"<Part><PartNumber>{n}</PartNumber><ETag>{etags[n]}</ETag></Part>"
+                            for n in sorted(etags))
+            _, body = self._request("POST", key, query={"uploadId": upload_id},
+                                    body=f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode("utf-8"))
+            if _find(ElementTree.fromstring(body), "Error"):
+                # S3 can report a failed completion in a 200 response
+                raise S3Error(200, "CompleteMultipartUpload failed", body)
+            return total
+        except BaseException:
+            try:
+                self._request("DELETE", key, query={"uploadId": upload_id}, ok=(200, 204, 404))
+            except Exception:
+                pass
+            raise
+
+    def get(self, key):
+        return self._request("GET", key, stream=True)
+
+    def download(self, key, path):
+        size = self.stat(key)
+        if size is None:
+            raise FileNotFoundError(f"Not found in bucket {self.bucket}: {key}")
+        if size <= self.part_size:
+            return super().download(key, path)
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+        def fetch(start):
+            end = min(start + self.part_size, size) - 1
+            response = self._request("GET", key, headers={"Range": f"bytes={start}-{end}"}, ok=(206,), stream=True)
+            with response, open(path, "r+b") as f:
+                f.seek(start)
+                shutil.copyfileobj(response, f, COPY_BUFFER_SIZE)
+                if f.tell() != end + 1:
+                    raise S3Error(206, f"Short read of bytes {start}-{end}")
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for _ in executor.map(fetch, range(0, size, self.part_size)):
+                pass
+
+    def delete(self, key):
+        self._request("DELETE", key, ok=(200, 204, 404))
+
+    def stat(self, key):
+        try:
+            response, _ = self._request("HEAD", key)
+        except FileNotFoundError:
+            return None
+        return int(response.getheader("Content-Length", 0))
+
+    def list(self, prefix=""):
+        from xml.etree import ElementTree
+        query = {"list-type": "2", "prefix": self.prefix + prefix}
+        while True:
+            _, body = self._request("GET", query=query)
+            root = ElementTree.fromstring(body)
+            for contents in _find(root, "Contents"):
+                yield _find(contents, "Key")[0].text[len(self.prefix):]
+            token = _find(root, "NextContinuationToken")
+            truncated = _find(root, "IsTruncated")
+            if not token or not truncated or truncated[0].text != "true":
+                return
+            query["continuation-token"] = token[0].text
+
+
+def read_full(stream, size):
+    """Read size bytes, or up to the end of the stream, whatever size the reads return"""
+    data = stream.read(size)
+    while 0 < len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+STORAGE_BACKENDS = {"local": LocalBackend, "s3": S3Backend}
+
+
+def open_backend(config):
+    """Backend described by a "storage_backend" setting"""
+    if not config:
+        raise ValueError('"storage_mode": "remote" needs a "storage_backend" setting')
+    config = dict(config)
+    kind = config.pop("type", "local")
+    if kind not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend type: {kind!r}")
+    return STORAGE_BACKENDS[kind](**config)
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+File Version Saver - version viewer
+Tkinter window listing the saved versions of a file, plus the small dialogs the command
+line falls back to. Kept apart from version_saver so headless commands never load Tk.
+"""
+
+import os
+import queue
+import threading
+import tkinter as tk
+from tkinter import ttk, messagebox, filedialog, simpledialog
+from datetime import datetime
+from pathlib import Path
+
+from version_saver import VersionSaver, format_size
+
+# Rows inserted into the version list per UI tick while loading
+ROWS_PER_PAGE = 200
+# Milliseconds between checks for finished background work
+POLL_INTERVAL_MS = 50
+# Diff lines shown by Compare; longer diffs are cut off (the diff command prints them all)
+DIFF_VIEW_LINES = 20000
+
+
+def version_row(version):
+    """Treeview values for a version: timestamp, size, modified date and comment"""
+    metadata = version["metadata"]
+    file_size = metadata.get("file_size", 0)
+    stored_size = metadata.get("stored_size", file_size)
+    file_modified = metadata.get("file_modified", "")
+    
+    # Format file size, with the stored size when compression saved space
+    size_str = format_size(file_size)
+    if stored_size < file_size:
+        size_str += f" ({format_size(stored_size)} stored)"
+    
+    # Format modified date
+    try:
+        modified_dt = datetime.fromisoformat(file_modified)
+        modified_str = modified_dt.strftime("%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        modified_str = file_modified
+    
+    return version["timestamp"], size_str, modified_str, metadata.get("comment", "")
+
+
+class VersionViewer(tk.Tk):
+    """Version list for one file. Index queries and file copies run on a worker thread,
+    one task at a time, and their results are handed back to the Tk thread through a
+    queue, so the window stays responsive while thousands of versions load or a large
+    file is saved or restored."""
+
+    def __init__(self, file_path, version_saver=None):
+        super().__init__()
+        
+        self.file_path = Path(file_path)
+        # The background service's saver (see version_daemon) when it is running;
+        # otherwise one is created on the worker thread, since opening the index can be slow
+        self.version_saver = version_saver
+        self._tasks = queue.Queue()
+        self._results = queue.Queue()
+        self._pending = 0
+        self._closing = False
+        self._load_generation = 0
+        threading.Thread(target=self._work, daemon=True).start()
+        
+        self.title(f"File Versions - {self.file_path.name}")
+        self.geometry("740x450")
+        self.resizable(True, True)
+        
+        # Center window
+        self.center_window()
+        
+        self.setup_ui()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.after(POLL_INTERVAL_MS, self._poll_results)
+        self.load_versions()
+    
+    def _work(self):
+        """Worker thread: run queued tasks in order and post their outcome back"""
+        while True:
+            task, on_done = self._tasks.get()
+            try:
+                if self.version_saver is None:
+                    self.version_saver = VersionSaver()
+                outcome = (task(self.version_saver), None)
+            except Exception as e:
+                outcome = (None, e)
+            self._results.put((on_done, outcome))
+    
+    def run_in_background(self, task, on_done, status=None):
+        """Run task(version_saver) on the worker thread, then on_done(result, error) on the
+        Tk thread"""
+        if status:
+            self.status_var.set(status)
+        self._pending += 1
+        self._tasks.put((task, on_done))
+    
+    def _poll_results(self):
+        while True:
+            try:
+                on_done, (result, error) = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._pending -= 1
+            if self._closing:
+                continue
+            on_done(result, error)
+        if self._closing and not self._pending:
+            self.destroy()
+            return
+        self.after(POLL_INTERVAL_MS, self._poll_results)
+    
+    def on_close(self):
+        """Close the window, first letting a save, restore or remove in progress finish"""
+        if self._pending:
+            self._closing = True
+            self.withdraw()
+        else:
+            self.destroy()
+    
+    def center_window(self):
+        """Center the window on screen"""
+        self.update_idletasks()
+        width = self.winfo_width()
+        height = self.winfo_height()
+        x = (self.winfo_screenwidth() // 2) - (width // 2)
+        y = (self.winfo_screenheight() // 2) - (height // 2)
+        self.geometry(f"{width}x{height}+{x}+{y}")
+    
+    def setup_ui(self):
+        """Setup the user interface"""
+        # Main frame
+        main_frame = ttk.Frame(self, padding="10")
+        main_frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        
+        # Configure grid weights
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        main_frame.columnconfigure(1, weight=1)
+        main_frame.rowconfigure(2, weight=1)
+        
+        # File info
+        ttk.Label(main_frame, text=f"File: {self.file_path.name}", font=("Arial", 12, "bold")).grid(row=0, column=0, columnspan=3, sticky=tk.W, pady=(0, 10))
+        ttk.Label(main_frame, text=f"Original Path: {self.file_path.absolute()}", font=("Arial", 9)).grid(row=1, column=0, columnspan=3, sticky=tk.W, pady=(0, 2))
+        
+        # Selected version path label
+        self.selected_version_path_var = tk.StringVar()
+        self.selected_version_path_var.set("")
+        self.selected_version_path_label = ttk.Label(main_frame, textvariable=self.selected_version_path_var, font=("Arial", 8, "italic"))
+        self.selected_version_path_label.grid(row=2, column=0, columnspan=3, sticky=tk.W, pady=(0, 10))
+        
+        # Versions list
+        ttk.Label(main_frame, text="Saved Versions:", font=("Arial", 10, "bold")).grid(row=3, column=0, sticky=tk.W, pady=(0, 5))
+        
+        # Create treeview for versions
+        columns = ("Timestamp", "Size", "Modified", "Comment")
+        self.tree = ttk.Treeview(main_frame, columns=columns, show="headings", height=10)
+        
+        # Configure columns
+        self.tree.heading("Timestamp", text="Timestamp")
+        self.tree.heading("Size", text="Size")
+        self.tree.heading("Modified", text="Modified")
+        self.tree.heading("Comment", text="Comment")
+        
+        self.tree.column("Timestamp", width=150)
+        self.tree.column("Size", width=160)
+        self.tree.column("Modified", width=150)
+        self.tree.column("Comment", width=200)
+        
+        # Scrollbar
+        scrollbar = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        
+        self.tree.grid(row=4, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(0, 10))
+        scrollbar.grid(row=4, column=2, sticky=(tk.N, tk.S), pady=(0, 10))
+        
+        # Buttons frame
+        button_frame = ttk.Frame(main_frame)
+        button_frame.grid(row=5, column=0, columnspan=3, pady=(10, 0))
+        
+        ttk.Button(button_frame, text="Save Version", command=self.save_version_with_comment).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Open Selected", command=self.open_selected).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Restore Selected", command=self.restore_selected).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Remove Selected", command=self.remove_selected).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Compare", command=self.compare_selected).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Refresh", command=self.load_versions).pack(side=tk.LEFT, padx=(0, 10))
+        
+        # Bind double-click to open
+        self.tree.bind("<Double-1>", lambda e: self.open_selected())
+        # Bind selection change to update selected version path
+        self.tree.bind("<<TreeviewSelect>>", self.on_version_select)
+        
+        # Status bar
+        self.status_var = tk.StringVar()
+        self.status_var.set("Ready")
+        status_bar = ttk.Label(main_frame, textvariable=self.status_var, relief=tk.SUNKEN, anchor=tk.W)
+        status_bar.grid(row=6, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=(10, 0))
+    
+    def on_version_select(self, event=None):
+        """Update the selected version path label when a version is selected"""
+        version_path = self.get_selected_version_path()
+        if version_path:
+            # Show only up to the folder before .versiontracker
+            norm_path = os.path.normpath(version_path)
+            parts = norm_path.split(os.sep)
+            if ".versiontracker" in parts:
+                idx = parts.index(".versiontracker")
+                base_path = os.sep.join(parts[:idx])
+                self.selected_version_path_var.set(f"Selected version path: {base_path}")
+            else:
+                self.selected_version_path_var.set(f"Selected version path: {os.path.dirname(version_path)})")
+        else:
+            self.selected_version_path_var.set("")
+    
+    def load_versions(self):
+        """Load versions on the worker thread and display them a page at a time"""
+        # A newer load supersedes any still being fed into the tree
+        self._load_generation += 1
+        generation = self._load_generation
+        
+        def query(version_saver):
+            versions = version_saver.get_versions(self.file_path)
+            return [(version_row(version), version["path"]) for version in versions]
+        
+        def loaded(rows, error):
+            if generation != self._load_generation:
+                return
+            if error is not None:
+                self.status_var.set(f"Error loading versions: {error}")
+                return
+            # Clear existing items
+            self.tree.delete(*self.tree.get_children())
+            # Clear selected version path label after reload
+            self.selected_version_path_var.set("")
+            if not rows:
+                self.status_var.set("No saved versions found")
+                return
+            self._insert_rows(rows, 0, generation)
+        
+        self.run_in_background(query, loaded, status="Loading versions...")
+    
+    def _insert_rows(self, rows, start, generation):
+        """Insert one page of rows, then yield to the event loop before the next"""
+        if generation != self._load_generation:
+            return
+        end = min(start + ROWS_PER_PAGE, len(rows))
+        for values, version_path in rows[start:end]:
+            self.tree.insert("", "end", values=values, tags=(version_path,))
+        if end < len(rows):
+            self.status_var.set(f"Loading versions... {end} of {len(rows)}")
+            self.after(1, self._insert_rows, rows, end, generation)
+        else:
+            self.status_var.set(f"Found {len(rows)} version(s)")
+    
+    def get_selected_version_path(self):
+        """Get the file path of the selected version"""
+        selection = self.tree.selection()
+        if not selection:
+            return None
+        
+        item = self.tree.item(selection[0])
+        tags = item.get("tags", [])
+        if tags:
+            return tags[0]
+        return None
+    
+    def open_selected(self):
+        """Open the selected version"""
+        version_path = self.get_selected_version_path()
+        if not version_path:
+            messagebox.showwarning("No Selection", "Please select a version to open.")
+            return
+        
+        def opened(result, error):
+            success, message = result if error is None else (False, str(error))
+            if not success:
+                messagebox.showerror("Error", message)
+                self.status_var.set("Error opening version")
+            else:
+                self.status_var.set("File opened")
+        
+        self.run_in_background(lambda version_saver: version_saver.open_version(version_path), opened,
+                               status="Opening version...")
+    
+    def restore_selected(self):
+        """Restore the selected version"""
+        version_path = self.get_selected_version_path()
+        if not version_path:
+            messagebox.showwarning("No Selection", "Please select a version to restore.")
+            return
+        
+        # Confirm restoration
+        result = messagebox.askyesno(
+            "Confirm Restore",
+            f"Are you sure you want to restore this version?\n\n"
+            f"This will replace the current file:\n{self.file_path.name}\n\n"
+            f"A backup will be created as {self.file_path.name}.backup"
+        )
+        
+        if result:
+            def restored(result, error):
+                success, message = result if error is None else (False, str(error))
+                if success:
+                    self.status_var.set("Version restored")
+                    messagebox.showinfo("Success", message)
+                else:
+                    self.status_var.set("Error restoring version")
+                    messagebox.showerror("Error", message)
+            
+            self.run_in_background(
+                lambda version_saver: version_saver.restore_version(version_path, self.file_path),
+                restored, status="Restoring version...",
+            )
+    
+    def remove_selected(self):
+        """Remove the selected version"""
+        version_path = self.get_selected_version_path()
+        if not version_path:
+            messagebox.showwarning("No Selection", "Please select a version to remove.")
+            return
+        
+        # Get version timestamp for confirmation message
+        selection = self.tree.selection()
+        item = self.tree.item(selection[0])
+        timestamp = item.get("values", [""])[0]
+        
+        # Confirm removal
+        result = messagebox.askyesno(
+            "Confirm Remove",
+            f"Are you sure you want to remove this version?\n\n"
+            f"Version: {timestamp}\n"
+            f"File: {self.file_path.name}\n\n"
+            f"This action cannot be undone."
+        )
+        
+        if result:
+            def removed(result, error):
+                success, message = result if error is None else (False, str(error))
+                if success:
+                    # Refresh the list to show updated versions
+                    self.load_versions()
+                    messagebox.showinfo("Success", message)
+                else:
+                    self.status_var.set("Error removing version")
+                    messagebox.showerror("Error", message)
+            
+            self.run_in_background(lambda version_saver: version_saver.remove_version(version_path), removed,
+                                   status="Removing version...")
+    
+    def compare_selected(self):
+        """Compare two selected versions, or one selected version with the current file"""
+        selection = self.tree.selection()
+        if not selection or len(selection) > 2:
+            messagebox.showwarning("No Selection", "Please select one version to compare with the current file, or two versions to compare.")
+            return
+        paths = [self.tree.item(item).get("tags", [""])[0] for item in selection]
+        if len(paths) == 1:
+            path_a, path_b = paths[0], str(self.file_path)
+        else:
+            # The list is newest first, so show the change from the older to the newer
+            path_b, path_a = paths
+        
+        def compared(result, error):
+            if error is not None:
+                self.status_var.set("Error comparing versions")
+                messagebox.showerror("Error", f"Error comparing versions: {error}")
+                return
+            if result["identical"]:
+                self.status_var.set("No differences")
+                messagebox.showinfo("Compare", "The contents are identical.")
+                return
+            self.status_var.set(f"{len(result['lines'])} line(s) of differences")
+            self.show_diff(result["lines"], result["truncated"])
+        
+        self.run_in_background(
+            lambda version_saver: version_saver.diff_versions(path_a, path_b, max_lines=DIFF_VIEW_LINES),
+            compared, status="Comparing...",
+        )
+    
+    def show_diff(self, lines, truncated=False):
+        """Show diff lines in a window, with removed and added lines coloured"""
+        window = tk.Toplevel(self)
+        window.title(f"Compare - {self.file_path.name}")
+        window.geometry("800x500")
+        window.columnconfigure(0, weight=1)
+        window.rowconfigure(0, weight=1)
+        text = tk.Text(window, wrap=tk.NONE, font=("Courier", 9))
+        y_scroll = ttk.Scrollbar(window, orient=tk.VERTICAL, command=text.yview)
+        x_scroll = ttk.Scrollbar(window, orient=tk.HORIZONTAL, command=text.xview)
+        text.configure(yscrollcommand=y_scroll.set, xscrollcommand=x_scroll.set)
+        text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        y_scroll.grid(row=0, column=1, sticky=(tk.N, tk.S))
+        x_scroll.grid(row=1, column=0, sticky=(tk.W, tk.E))
+        text.tag_configure("removed", foreground="#b31d28", background="#ffeef0")
+        text.tag_configure("added", foreground="#22863a", background="#f0fff4")
+        text.tag_configure("hunk", foreground="#6f42c1")
+        for line in lines:
+            if line.startswith(("---", "+++")):
+                tag = ()
+            elif line.startswith("-"):
+                tag = ("removed",)
+            elif line.startswith("+"):
+                tag = ("added",)
+            elif line.startswith("@@"):
+                tag = ("hunk",)
+            else:
+                tag = ()
+            text.insert(tk.END, line + "\n", tag)
+        if truncated:
+            text.insert(tk.END, f"... only the first {len(lines)} lines are shown; use the diff command for the rest\n")
+        text.configure(state=tk.DISABLED)
+    
+    def save_version_with_comment(self):
+        """Prompt for a comment and save a version"""
+        comment = simpledialog.askstring("Add Comment", "Enter a comment for this version:")
+        if comment is None:
+            self.status_var.set("Save cancelled")
+            return
+        
+        def saved(result, error):
+            success, message = result if error is None else (False, str(error))
+            if success:
+                self.load_versions()
+                messagebox.showinfo("Success", message)
+            else:
+                self.status_var.set("Error saving version")
+                messagebox.showerror("Error", message)
+        
+        self.run_in_background(lambda version_saver: version_saver.save_version(self.file_path, comment), saved,
+                               status="Saving version...")
+
+
+def prompt_for_comment_tk(title="Add Comment", prompt="Enter a comment for this version:"):
+    root = tk.Tk()
+    root.withdraw()
+    comment = simpledialog.askstring(title, prompt)
+    root.destroy()
+    return comment
+
+
+def ask_directory(title):
+    """Folder picker without a main window; returns "" if cancelled"""
+    root = tk.Tk()
+    root.withdraw()
+    chosen_dir = filedialog.askdirectory(title=title)
+    root.destroy()
+    return chosen_dir
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+File Version Saver - watcher
+Saves versions automatically when watched files change: inotify on Linux, polling
+elsewhere. Bursts of writes are debounced, editors' write-temp-then-rename saves are
+coalesced into one version, and each file is saved at most once per interval.
+"""
+
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+
+from version_saver import path_wanted
+
+# inotify event bits (<sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+def _walk_dirs(root, recursive=True):
+    """root and (if recursive) every folder below it, skipping .versiontracker stores"""
+    if not recursive:
+        yield Path(root)
+        return
+    for dirpath, dirs, _ in os.walk(root):
+        dirs[:] = [d for d in dirs if d != ".versiontracker"]
+        yield Path(dirpath)
+
+
+class InotifyBackend:
+    """Change notifications from the Linux kernel, one watch per directory"""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+        self._recursive = set()
+
+    def add_dir(self, path, recursive=True):
+        """Watch path (and every folder below it); returns the files already in them"""
+        files = []
+        for folder in _walk_dirs(path, recursive):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+            if wd >= 0:
+                self._dirs[wd] = folder
+                if recursive:
+                    self._recursive.add(wd)
+            with os.scandir(folder) as it:
+                files.extend(Path(entry.path) for entry in it if entry.is_file())
+        return files
+
+    def read_events(self, timeout):
+        """Paths that changed, waiting up to timeout seconds (None = until something happens).
+        Returns None after a queue overflow, when the caller should rescan everything."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            folder = self._dirs.get(wd)
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if folder is None or not name:
+                continue
+            path = folder / os.fsdecode(name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and wd in self._recursive and path.name != ".versiontracker":
+                    # Files may land in a new folder before its watch is in place
+                    changed.extend(self.add_dir(path))
+                continue
+            changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingBackend:
+    """Portable fallback: rescan the watched folders every interval seconds and report
+    files whose size or modification time changed"""
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self._roots = []
+        self._seen = {}
+        self._next_scan = 0.0
+
+    def add_dir(self, path, recursive=True):
+        self._roots.append((Path(path), recursive))
+        files = []
+        for path, stamp in self.scan(Path(path), recursive):
+            self._seen[path] = stamp
+            files.append(path)
+        return files
+
+    @staticmethod
+    def scan(root, recursive=True):
+        """(path, (mtime_ns, size)) for every file under root"""
+        for folder in _walk_dirs(root, recursive):
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if entry.is_file():
+                            st = entry.stat()
+                            yield Path(entry.path), (st.st_mtime_ns, st.st_size)
+            except OSError:
+                continue  # removed while scanning
+
+    def read_events(self, timeout):
+        wait = max(0.0, self._next_scan - time.monotonic())
+        if timeout is not None:
+            wait = min(wait, timeout)
+        time.sleep(wait)
+        if time.monotonic() < self._next_scan:
+            return []
+        self._next_scan = time.monotonic() + self.interval
+        current = {}
+        for root, recursive in self._roots:
+            current.update(self.scan(root, recursive))
+        changed = [path for path, stamp in current.items() if self._seen.get(path) != stamp]
+        changed.extend(path for path in self._seen if path not in current)  # deleted or renamed away
+        self._seen = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class FileWatcher:
+    """Save versions of files under the watched paths when they change.
+
+    A change schedules the file for saving once it has been quiet for debounce seconds;
+    further events push that back, so a burst of writes (or a temp-file-and-rename save)
+    yields one version. A file whose size or mtime is still moving when it comes due, or
+    changes while it is being copied, is retried later rather than saved half-written.
+    Each file is saved at most once per min_interval seconds; later changes are saved when
+    the interval ends. All saves go through one VersionSaver and its loaded index."""
+
+    def __init__(self, version_saver, paths, include=None, exclude=None, comment="Auto-saved",
+                 debounce=None, min_interval=None, backend=None):
+        settings = version_saver.settings
+        self.version_saver = version_saver
+        self.comment = comment
+        self.include = list(include or [])
+        self.exclude = list(exclude or []) + list(settings["watch_ignore"])
+        self.debounce = settings["watch_debounce"] if debounce is None else debounce
+        self.min_interval = settings["watch_min_interval"] if min_interval is None else min_interval
+        if backend is None:
+            try:
+                backend = InotifyBackend()
+            except (OSError, AttributeError):
+                backend = PollingBackend(settings["watch_poll_interval"])
+        self.backend = backend
+        self._dirs = []  # watched trees
+        self._files = set()  # individually watched files
+        self._due = {}  # path -> monotonic time it may be saved
+        self._stamps = {}  # path -> (mtime_ns, size) when it was scheduled
+        self._last_saved = {}
+        self.saved = 0
+        for path in paths:
+            path = Path(path).resolve()
+            if path.is_dir():
+                self._dirs.append(path)
+                self.backend.add_dir(path)
+            else:
+                # Watch the folder so that replacing the file by rename is still seen
+                if not any(f.parent == path.parent for f in self._files):
+                    self.backend.add_dir(path.parent, recursive=False)
+                self._files.add(path)
+
+    def _watched(self, path):
+        if path not in self._files and not any(root in path.parents for root in self._dirs):
+            return False
+        if ".versiontracker" in path.parts:
+            return False
+        return path_wanted(path, self.include, self.exclude)
+
+    def _stamp(self, path):
+        try:
+            st = path.stat()
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def _schedule(self, path, now):
+        self._due[path] = max(now + self.debounce, self._last_saved.get(path, float("-inf")) + self.min_interval)
+        self._stamps[path] = self._stamp(path)
+
+    def step(self, timeout=None):
+        """Wait for changes (up to timeout) and save every file that has come due"""
+        now = time.monotonic()
+        if self._due:
+            wait = max(0.0, min(self._due.values()) - now)
+            timeout = wait if timeout is None else min(timeout, wait)
+        changed = self.backend.read_events(timeout)
+        now = time.monotonic()
+        if changed is None:
+            # Events were lost: treat every watched file as changed
+            changed = [p for root in self._dirs for p, _ in PollingBackend.scan(root)] + list(self._files)
+        for path in changed:
+            if self._watched(path):
+                self._schedule(path, now)
+        for path in [p for p, due in self._due.items() if due <= now]:
+            self._save_due(path, now)
+
+    def _save_due(self, path, now):
+        stamp = self._stamp(path)
+        if stamp is None:
+            # Gone (deleted, or renamed away mid-save); a rename back onto it schedules it again
+            del self._due[path]
+            self._stamps.pop(path, None)
+            return
+        if stamp != self._stamps.get(path):
+            self._schedule(path, now)  # still being written
+            return
+        status, message, entry = self.version_saver._save_version(path, self.comment)
+        if status == "saved" and self._stamp(path) != stamp:
+            # Modified while it was copied; drop the torn copy and save again once it settles
+            self.version_saver.remove_version(entry["version_file_path"])
+            self._schedule(path, time.monotonic())
+            return
+        del self._due[path]
+        self._stamps.pop(path, None)
+        if status == "saved":
+            self._last_saved[path] = now
+            self.saved += 1
+            print(f"✅ {path}: {message}")
+        elif status == "failed":
+            print(f"❌ {path}: {message}", file=sys.stderr)
+
+    def run(self, stop=None):
+        """Watch until KeyboardInterrupt or until stop (a threading.Event) is set"""
+        try:
+            while stop is None or not stop.is_set():
+                self.step(timeout=1.0 if stop is not None else None)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.backend.close()